@@ -21,21 +21,25 @@ import pandas as pd
 import logging
 from datetime import datetime
 import finnhub
-import csv
 import time
 import pdb
+from functools import lru_cache
 
 load_dotenv()
 
 
 os.makedirs("output", exist_ok=True)
+# One sink per audience: full trail in dev.log, errors in error.log, only warnings+ on the console
+dev_handler = logging.FileHandler('output/dev.log')
+dev_handler.setLevel(logging.DEBUG)
+error_handler = logging.FileHandler('output/error.log')
+error_handler.setLevel(logging.ERROR)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.WARNING)
 logging.basicConfig(
-    level=logging.ERROR,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),  # DEBUG adds per-row progress to dev.log
     format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('output/error.log'),
-        logging.StreamHandler()  # Also print to console
-    ]
+    handlers=[dev_handler, error_handler, console_handler]
 )
 
 
@@ -48,6 +52,45 @@ if not API_KEY:
     raise ValueError("FINNHUB_API_KEY not found in .env file")
 finnhub_client = finnhub.Client(api_key=API_KEY)
 
+MAX_CALLS_PER_MIN = int(os.getenv("MAX_CALLS_PER_MIN", "60"))  # Finnhub free tier ~60/min
+
+
+class MinuteRateLimiter:
+    """Token bucket refilled continuously at max_per_minute/60 tokens per second."""
+    def __init__(self, max_per_minute: int):
+        self.capacity = max_per_minute
+        self.rate = max_per_minute / 60.0
+        self.tokens = float(max_per_minute)
+        self.last = time.monotonic()
+
+    def acquire(self, n: int = 1):
+        """Take n tokens, sleeping only as long as needed when the bucket is empty."""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= n:
+                self.tokens -= n
+                return
+            time.sleep((n - self.tokens) / self.rate)
+
+
+rate_limiter = MinuteRateLimiter(MAX_CALLS_PER_MIN)
+
+
+# Profiles and symbol lookups are near-static, so duplicate names/symbols in the
+# input are served from memory instead of spending another API call
+@lru_cache(maxsize=4096)
+def lookup_symbol(name):
+    rate_limiter.acquire()
+    return finnhub_client.symbol_lookup(name)
+
+
+@lru_cache(maxsize=4096)
+def fetch_profile(symbol):
+    rate_limiter.acquire()
+    return finnhub_client.company_profile2(symbol=symbol)
+
 
 logger = logging.getLogger(__name__)
 
@@ -62,91 +105,105 @@ print(f"Using input file: {INPUT_FILE}")
 
 
 expected_columns = ["Name", "Symbol", "Price", "# of Shares", "Market Value"]
-# Load the CSV
-data = pd.read_csv(INPUT_FILE)
+# Load the CSV: only the expected columns are parsed, with explicit dtypes instead of inference.
+# Value columns stay as text, so a formatted cell like "$12" passes through instead of aborting the read
+data = pd.read_csv(
+    INPUT_FILE,
+    usecols=lambda col: col in expected_columns,
+    dtype={"Name": "string", "Symbol": "string", "Price": str,
+           "# of Shares": str, "Market Value": str},
+)
 # Validate column names
-if not all(col in data.columns for col in expected_columns):
+if not set(expected_columns).issubset(data.columns):
     error_msg = f"Input file must contain columns: {expected_columns}"
     logger.error(error_msg)
     raise ValueError(error_msg)
 
+# Normalize the key columns in one vectorized pass instead of str()/strip() per row
+data["Name"] = data["Name"].fillna("").astype(str).str.strip()
+data["Symbol"] = data["Symbol"].fillna("").astype(str).str.strip()
+
 print("\n--- Preview of Input Data ---")
 print(data.head(), "\n")
 
+# If both Name and Symbol are missing, log error and skip (checked column-wise, not per row)
+bad = (data["Name"] == "") & (data["Symbol"] == "")
+if bad.any():
+    error_msg = f"Rows {(data.index[bad] + 1).tolist()} are missing both Name and Symbol, skipping"
+    logger.error(error_msg)
+    data = data.loc[~bad]
+
+# Export the key columns once to plain dicts (already normalized, blanks are "") so the loop
+# below does dict lookups, not pandas access; values come from the merge further down
+records = data[["Name", "Symbol"]].to_dict(orient="records")
 
-# Create temp file with headers
-with open(TEMP_FILE, "w", newline="") as f:
-    writer = csv.DictWriter(f, fieldnames=expected_columns)
-    writer.writeheader()
 
-for idx, row in data.iterrows():
-    name   = str(row["Name"]).strip() if not pd.isna(row["Name"]) else ""
-    symbol = str(row["Symbol"]).strip() if not pd.isna(row["Symbol"]) else ""
-    price = row["Price"] if not pd.isna(row["Price"]) else ""
-    shares_outstanding = row["# of Shares"] if not pd.isna(row["# of Shares"]) else ""
-    market_value = row["Market Value"] if not pd.isna(row["Market Value"]) else ""
-    # If both missing, log error and skip
+# Resolve missing Name/Symbol per row (lookups and profiles are memoized per key)
+keep, names, symbols = [], [], []
+for idx, row in zip(data.index, records):
+    name   = row["Name"]
+    symbol = row["Symbol"]
     try:
-        print(f"Processing row {idx+1}: Name='{name}', Symbol='{symbol}'")
-        # Add your API calls and data processing logic here
-        # Example: finnhub_client.company_profile2(symbol=symbol)
+        logger.debug("Processing row %d: Name='%s', Symbol='%s'", idx+1, name, symbol)
         #if only name is present
         if not symbol and name:
-            lookup = finnhub_client.symbol_lookup(name)
+            lookup = lookup_symbol(name)
             if lookup["count"] > 0:
                 symbol = lookup["result"][0]["symbol"]
-                print(f"Found symbol '{symbol}' for company '{name}'.")
+                logger.debug("Found symbol '%s' for company '%s'.", symbol, name)
             else:
-                print(f"No symbol found for '{name}'.")
+                logger.warning("Row %d: No symbol found for '%s', skipping.", idx+1, name)
                 continue
         elif not name and symbol:
-            profile = finnhub_client.company_profile2(symbol=symbol)
+            profile = fetch_profile(symbol)
             name = profile.get("name", "")
             if not name:
-                print(f"No name found for symbol '{symbol}'.")
+                logger.warning("Row %d: No name found for symbol '%s', skipping.", idx+1, symbol)
                 continue
-            print(f"Found name '{name}' for symbol '{symbol}'.")
+            logger.debug("Found name '%s' for symbol '%s'.", name, symbol)
         else:
             # Both name and symbol are present, verify the data
-            print(f"Both name and symbol present for '{name}' with symbol '{symbol}'.")
-
-        profile = finnhub_client.company_profile2(symbol=symbol)
-        quote = finnhub_client.quote(symbol)
-
-        if not price or price == "":
-            price = quote.get("c", "")
-            print(f"Row {idx}: Updated price = {price}")
-
-        if not shares_outstanding or shares_outstanding == "":
-            shares_outstanding = profile.get("shareOutstanding", "")
-            print(f"Row {idx}: Updated shares outstanding = {shares_outstanding}")
-
-        if not market_value or market_value == "":
-            market_value = profile.get("marketCapitalization", "")
-            print(f"Row {idx}: Updated market value = {market_value}")
-
-        print(f"Row {idx}: ## Updated and written to file.\n")
+            logger.debug("Both name and symbol present for '%s' with symbol '%s'.", name, symbol)
 
-        time.sleep(1.0) #Free API is throttled , so need to wait a second, we can make 60 calls in a minute
+        keep.append(idx)
+        names.append(name)
+        symbols.append(symbol)
 
-        updated_row = {
-            "Name": name,
-            "Symbol": symbol,
-            "Price": price,
-            "# of Shares": shares_outstanding,
-            "Market Value": market_value
-        }
+    except Exception as e:
+        error_msg = f"Error processing row {idx+1} (Name='{name}', Symbol='{symbol}'): {str(e)}"
+        logger.error(error_msg)
 
-        # pdb.set_trace();
-        with open(TEMP_FILE, "a", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=expected_columns)
-            writer.writerow(updated_row)
+data = data.loc[keep].assign(Name=names, Symbol=symbols)
 
+# Fetch profile + quote once per unique symbol; the loop does nothing but API calls
+enriched = []
+for symbol in data["Symbol"].unique():
+    try:
+        profile = fetch_profile(symbol)
+        rate_limiter.acquire()
+        quote = finnhub_client.quote(symbol)
     except Exception as e:
-        error_msg = f"Error processing row {idx+1} (Name='{name}', Symbol='{symbol}'): {str(e)}"
+        rows = (data.index[data["Symbol"] == symbol] + 1).tolist()
+        error_msg = f"Error processing rows {rows} (Symbol='{symbol}'): {str(e)}"
         logger.error(error_msg)
-        print(f"Error: {error_msg}")
-    continue
+        continue
+    enriched.append({
+        "Symbol": symbol,
+        "Price_api": quote.get("c"),
+        "Shares_api": profile.get("shareOutstanding"),
+        "MV_api": profile.get("marketCapitalization")
+    })
+enriched = pd.DataFrame(enriched, columns=["Symbol", "Price_api", "Shares_api", "MV_api"])
+
+# Fill the blanks column-wise; the inner merge drops rows whose symbol data couldn't be fetched
+merged = data.merge(enriched, on="Symbol", how="inner")
+merged["Price"] = merged["Price"].fillna(merged["Price_api"])
+merged["# of Shares"] = merged["# of Shares"].fillna(merged["Shares_api"])
+merged["Market Value"] = merged["Market Value"].fillna(merged["MV_api"])
+print(f"Enriched {len(merged)} rows for {len(enriched)} unique symbols.")
+
+# Write the temp file in a single pass
+merged[expected_columns].to_csv(TEMP_FILE, index=False)
 
 os.replace(TEMP_FILE, INPUT_FILE)
 print(f"\nIncremental update complete. Updated file saved at: {INPUT_FILE}")
\ No newline at end of file
@@ -1,32 +1,39 @@
 import os
-import csv
+import io
+import json
 import time
-import math
-import signal
+import random
 import logging
-import threading
-from queue import Queue, Empty
-from datetime import datetime
+import asyncio
 
+import aiohttp
+import aiofiles
 import pandas as pd
 from dotenv import load_dotenv
-import finnhub
 
 # ==========================
 # CONFIG (env-overridable)
 # ==========================
 load_dotenv()
 
+LOG_LEVEL                = os.getenv("LOG_LEVEL", "INFO").upper()      # DEBUG adds per-row trace to dev.log
 MAX_CALLS_PER_MIN        = int(os.getenv("MAX_CALLS_PER_MIN", "60"))  # Finnhub free tier ~60/min
-NUM_WORKERS              = int(os.getenv("NUM_WORKERS", "5"))
-SHORT_SLEEP_SECS         = float(os.getenv("SHORT_SLEEP_SECS", "0.25"))  # worker retry when tokens unavailable
+NUM_WORKERS              = int(os.getenv("NUM_WORKERS", "5"))          # rows enriched concurrently
+MAX_INFLIGHT             = int(os.getenv("MAX_INFLIGHT", str(2 * NUM_WORKERS)))  # concurrent HTTP requests (profile + quote per row)
 LOOKUP_NAME_MAXLEN       = int(os.getenv("LOOKUP_NAME_MAXLEN", "64"))    # avoid "q too long" (422)
+HTTP_TIMEOUT_SECS        = float(os.getenv("HTTP_TIMEOUT_SECS", "30"))
+HTTP_MAX_RETRIES         = int(os.getenv("HTTP_MAX_RETRIES", "5"))       # retries on 429 / 5xx
+FINNHUB_API_URL          = os.getenv("FINNHUB_API_URL") or "https://finnhub.io/api/v1"
 INPUT_FILE               = os.getenv("INPUT_FILE") or "input/data.csv"
 TEMP_FILE                = os.getenv("TEMP_FILE")  or "output/data_tmp.csv"
+JOURNAL_FILE             = os.getenv("JOURNAL_FILE") or "output/data_tmp.jsonl"  # enriched rows, replayed after a crash
 OUTPUT_DIR               = os.getenv("OUTPUT_DIR") or "output"
 ERROR_LOG                = os.getenv("ERROR_LOG")  or os.path.join(OUTPUT_DIR, "error.log")
 DEV_LOG                  = os.getenv("DEV_LOG")    or os.path.join(OUTPUT_DIR, "dev.log")
 
+CSV_CHUNK_ROWS           = int(os.getenv("CSV_CHUNK_ROWS", "65536"))  # input rows held in memory at once
+WRITE_BUFFER_BYTES       = 64 * 1024  # flush buffered journal lines to disk past this size
+
 EXPECTED_COLUMNS         = ["Name", "Symbol", "Price", "# of Shares", "Market Value"]
 
 API_KEY                  = os.getenv("FINNHUB_API_KEY")
@@ -36,23 +43,24 @@ os.makedirs(OUTPUT_DIR, exist_ok=True)
 # ==========================
 # LOGGING
 # ==========================
+error_handler = logging.FileHandler(ERROR_LOG)
+error_handler.setLevel(logging.ERROR)
+console_handler = logging.StreamHandler()  # console only shows warnings and errors
+console_handler.setLevel(logging.WARNING)
 logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(threadName)s - %(message)s",
-    handlers=[
-        logging.FileHandler(ERROR_LOG),
-        logging.StreamHandler()
-    ]
+    level=LOG_LEVEL,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[error_handler, console_handler]
 )
 log = logging.getLogger(__name__)
 
-# Separate lightweight dev logger if you want extra trace
+# Dev log keeps the full trace: dev_log debug lines plus everything logged above
 dev_handler = logging.FileHandler(DEV_LOG)
 dev_handler.setLevel(logging.DEBUG)
-dev_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(threadName)s - %(message)s"))
+dev_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+logging.getLogger().addHandler(dev_handler)
 dev_log = logging.getLogger("dev")
-dev_log.setLevel(logging.DEBUG)
-dev_log.addHandler(dev_handler)
+dev_log.setLevel(LOG_LEVEL)
 
 # ==========================
 # VALIDATE ENV / INPUTS
@@ -63,51 +71,39 @@ if not API_KEY:
 if not os.path.exists(INPUT_FILE):
     raise FileNotFoundError(f"Input file not found at: {INPUT_FILE}")
 
-# ==========================
-# FINNHUB CLIENT
-# ==========================
-finnhub_client = finnhub.Client(api_key=API_KEY)
-
 # ==========================
 # RATE LIMITER (token bucket)
 # ==========================
 class MinuteRateLimiter:
     """
-    Global token bucket that refills once per minute.
-    try_acquire() is non-blocking: returns False if no tokens, so workers can sleep
-    without blocking each other.
+    Global token bucket refilled continuously at max_per_minute/60 tokens per second.
+    Lives on the event loop: acquire() awaits until enough tokens have accrued, and
+    the lock hands tokens out to waiting rows in FIFO order.
     """
     def __init__(self, max_per_minute: int):
-        self.max = max_per_minute
-        self.tokens = max_per_minute
-        self.lock = threading.Lock()
-        self._stop = False
-        self.refill_thread = threading.Thread(target=self._refill_loop, name="RefillThread", daemon=True)
-        self.refill_thread.start()
-
-    def _refill_loop(self):
-        while not self._stop:
-            time.sleep(60.0)
-            with self.lock:
-                self.tokens = self.max
-
-    def try_acquire(self, n: int = 1) -> bool:
-        with self.lock:
-            if self.tokens >= n:
-                self.tokens -= n
-                return True
-            return False
-
-    def stop(self):
-        self._stop = True
+        self.capacity = max_per_minute
+        self.rate = max_per_minute / 60.0
+        self.tokens = float(max_per_minute)
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, n: int = 1):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                await asyncio.sleep((n - self.tokens) / self.rate)
 
 rate_limiter = MinuteRateLimiter(MAX_CALLS_PER_MIN)
 
 # ==========================
-# IO QUEUES
+# IO QUEUE
 # ==========================
-task_q = Queue()   # rows to process
-write_q = Queue()  # enriched rows to write
+write_q = asyncio.Queue()  # enriched rows to journal
 
 # ==========================
 # HELPERS
@@ -124,25 +120,70 @@ def truncate_query(q: str, maxlen: int) -> str:
         return q
     return q[:maxlen]
 
-def acquire_or_wait(calls_needed: int = 1):
-    """Non-blocking limiter: if not enough tokens, sleep a bit and retry."""
-    while True:
-        if rate_limiter.try_acquire(calls_needed):
-            return
-        time.sleep(SHORT_SLEEP_SECS)
+async def memoized(cache: dict, key, fetch):
+    """
+    Share one fetch per key: concurrent rows await the same in-flight task instead
+    of stampeding the API, and later rows reuse the finished result. Failed fetches
+    are evicted so the next row can retry.
+    """
+    task = cache.get(key)
+    if task is None:
+        task = cache[key] = asyncio.ensure_future(fetch())
+    try:
+        return await asyncio.shield(task)
+    except Exception:
+        if cache.get(key) is task:
+            del cache[key]
+        raise
+
+def retry_delay(attempt: int, retry_after) -> float:
+    """Honour a numeric Retry-After; otherwise back off 2^attempt seconds plus jitter."""
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = 0.0
+    return delay if delay > 0 else 2 ** attempt + random.random()
 
-def lookup_symbol_by_name(name: str) -> str:
+async def fetch_json(session: aiohttp.ClientSession, path: str, **params) -> dict:
+    """
+    GET a Finnhub endpoint. 429 and 5xx responses are retried with exponential
+    backoff so the row stays in flight; any other error status raises right away.
+    """
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        # 1 API call per attempt: every request that got a response counts against the quota
+        await rate_limiter.acquire()
+        async with session.get(f"{FINNHUB_API_URL}/{path}", params=params) as resp:
+            retryable = resp.status == 429 or resp.status >= 500
+            if not retryable or attempt == HTTP_MAX_RETRIES:
+                resp.raise_for_status()
+                return await resp.json() or {}
+            delay = retry_delay(attempt, resp.headers.get("Retry-After"))
+        dev_log.debug("/%s %s: HTTP %d, retry %d in %.1fs", path, params, resp.status, attempt+1, delay)
+        await asyncio.sleep(delay)
+
+async def get_symbol_lookup(session: aiohttp.ClientSession, query: str) -> dict:
+    return await fetch_json(session, "search", q=query)
+
+async def get_company_profile(session: aiohttp.ClientSession, symbol: str) -> dict:
+    return await fetch_json(session, "stock/profile2", symbol=symbol)
+
+async def get_quote(session: aiohttp.ClientSession, symbol: str) -> dict:
+    return await fetch_json(session, "quote", symbol=symbol)
+
+_lookup_cache = {}
+_profile_cache = {}
+
+async def lookup_symbol_by_name(session: aiohttp.ClientSession, name: str) -> str:
     """
     Use symbol_lookup with a truncated query to avoid 422 'q too long'.
     Prefer exact match by displaySymbol or description containing the name.
+    Memoized per query, so duplicate names in the input cost one API call.
     """
     if not name:
         return ""
     query = truncate_query(name, LOOKUP_NAME_MAXLEN)
 
-    # 1 API call
-    acquire_or_wait(1)
-    resp = finnhub_client.symbol_lookup(query)
+    resp = await memoized(_lookup_cache, query, lambda: get_symbol_lookup(session, query))
     count = int(resp.get("count", 0))
     if count == 0:
         return ""
@@ -166,20 +207,13 @@ def lookup_symbol_by_name(name: str) -> str:
     # Fallback to the first result
     return safe_get(results[0], "symbol", "")
 
-def fetch_profile(symbol: str) -> dict:
-    # 1 API call
-    acquire_or_wait(1)
-    return finnhub_client.company_profile2(symbol=symbol) or {}
+async def fetch_profile(session: aiohttp.ClientSession, symbol: str) -> dict:
+    # 1 API call per unique symbol (profiles are near-static, memoized)
+    return await memoized(_profile_cache, symbol, lambda: get_company_profile(session, symbol))
 
-def fetch_quote(symbol: str) -> dict:
+async def fetch_quote(session: aiohttp.ClientSession, symbol: str) -> dict:
     # 1 API call
-    acquire_or_wait(1)
-    return finnhub_client.quote(symbol) or {}
-
-def normalize_cell(x):
-    if pd.isna(x):
-        return ""
-    return x
+    return await get_quote(session, symbol)
 
 def build_updated_row(name, symbol, price, shares_outstanding, market_value, profile, quote):
     # Fill missing pieces from API responses
@@ -205,154 +239,233 @@ def build_updated_row(name, symbol, price, shares_outstanding, market_value, pro
     }
 
 # ==========================
-# WORKER
+# KEY RESOLUTION
 # ==========================
-def worker_loop():
-    while True:
-        try:
-            idx, row_dict = task_q.get(timeout=1.0)
-        except Empty:
-            # No more tasks right now; loop again
-            continue
+async def gather_by_key(sem: asyncio.Semaphore, keys, fetch) -> dict:
+    """Run fetch(key) once per key, NUM_WORKERS at a time; failures come back as exceptions."""
+    async def one(key):
+        async with sem:
+            return await fetch(key)
+    return dict(zip(keys, await asyncio.gather(*(one(k) for k in keys), return_exceptions=True)))
+
+async def resolve_missing_keys(session: aiohttp.ClientSession, sem: asyncio.Semaphore, df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Fill Symbol from Name (and Name from Symbol) once per unique value instead of once
+    per row, then broadcast the results back to every row sharing that value.
+    Rows whose symbol can't be resolved are logged and dropped.
+    """
+    needs_symbol = df["Symbol"].eq("") & df["Name"].ne("")
+    if needs_symbol.any():
+        found = await gather_by_key(sem, df.loc[needs_symbol, "Name"].unique(),
+                                    lambda name: lookup_symbol_by_name(session, name))
+        name_to_symbol = {}
+        for name, symbol in found.items():
+            if isinstance(symbol, Exception):
+                log.error(f"Lookup failed for '{name}': {symbol}")
+            else:
+                name_to_symbol[name] = symbol
+        df.loc[needs_symbol, "Symbol"] = df.loc[needs_symbol, "Name"].map(name_to_symbol).fillna("")
+
+        unresolved = needs_symbol & df["Symbol"].eq("")
+        if unresolved.any():
+            log.error(f"Rows {(df.index[unresolved] + 1).tolist()}: No symbol found for Names "
+                      f"{df.loc[unresolved, 'Name'].tolist()}. Skipping.")
+            df = df.loc[~unresolved]
+        dev_log.debug("Resolved symbols for %d unique names.", len(name_to_symbol))
+
+    # Profiles are memoized, so the workers reuse these instead of fetching them again
+    needs_name = df["Name"].eq("") & df["Symbol"].ne("")
+    if needs_name.any():
+        found = await gather_by_key(sem, df.loc[needs_name, "Symbol"].unique(),
+                                    lambda symbol: fetch_profile(session, symbol))
+        symbol_to_name = {symbol: safe_get(profile, "name", "")
+                          for symbol, profile in found.items() if not isinstance(profile, Exception)}
+        df.loc[needs_name, "Name"] = df.loc[needs_name, "Symbol"].map(symbol_to_name).fillna("")
+
+    return df
 
+# ==========================
+# WORKER
+# ==========================
+async def enrich_record(session: aiohttp.ClientSession, sem: asyncio.Semaphore, idx: int, row_dict: dict):
+    """Return the enriched row (also queued for the journal), or None if it was skipped."""
+    async with sem:
         try:
-            name   = str(normalize_cell(row_dict.get("Name"))).strip()
-            symbol = str(normalize_cell(row_dict.get("Symbol"))).strip()
-            price  = normalize_cell(row_dict.get("Price"))
-            shares = normalize_cell(row_dict.get("# of Shares"))
-            mktval = normalize_cell(row_dict.get("Market Value"))
-
-            if not name and not symbol:
-                msg = f"Row {idx+1}: both Name and Symbol missing. Skipping."
-                log.error(msg)
-                task_q.task_done()
-                continue
-
-            # Resolve name/symbol if needed
-            if not symbol and name:
-                try:
-                    symbol = lookup_symbol_by_name(name)
-                    if not symbol:
-                        log.error(f"Row {idx+1}: No symbol found for '{name}'. Skipping.")
-                        task_q.task_done()
-                        continue
-                    dev_log.debug(f"Row {idx+1}: Resolved symbol '{symbol}' from name '{name}'.")
-                except finnhub.FinnhubAPIException as e:
-                    log.error(f"Row {idx+1}: Lookup failed for '{name}': {e}")
-                    task_q.task_done()
-                    continue
-
-            # If we have symbol, try to enrich
-            if symbol:
-                try:
-                    profile = fetch_profile(symbol)
-                    # If name missing, populate from profile later
-                except finnhub.FinnhubAPIException as e:
-                    log.error(f"Row {idx+1}: Profile fetch failed for '{symbol}': {e}")
-                    task_q.task_done()
-                    continue
-
-                try:
-                    quote = fetch_quote(symbol)
-                except finnhub.FinnhubAPIException as e:
-                    log.error(f"Row {idx+1}: Quote fetch failed for '{symbol}': {e}")
-                    task_q.task_done()
-                    continue
-
-                updated = build_updated_row(name, symbol, price, shares, mktval, profile, quote)
-                write_q.put(updated)
-                dev_log.debug(f"Row {idx+1}: Enriched and queued for write.")
-
-            else:
-                # Shouldn't reach here given checks above
-                log.error(f"Row {idx+1}: Missing symbol after resolution. Skipping.")
+            name   = row_dict.get("Name")
+            symbol = row_dict.get("Symbol")
+            price  = row_dict.get("Price")
+            shares = row_dict.get("# of Shares")
+            mktval = row_dict.get("Market Value")
+
+            # Profile and quote are independent: issue both at once (one token each) so
+            # the row waits one round-trip instead of two. The TaskGroup cancels the other
+            # fetch as soon as one fails, so a row that is dropped stops spending tokens
+            try:
+                async with asyncio.TaskGroup() as tg:
+                    profile_task = tg.create_task(fetch_profile(session, symbol))
+                    quote_task = tg.create_task(fetch_quote(session, symbol))
+            except ExceptionGroup as eg:
+                e = eg.exceptions[0]
+                if isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)):
+                    log.error("Row %d: Profile/quote fetch failed for '%s': %s", idx+1, symbol, e)
+                else:
+                    log.error("Row %d: Unexpected error: %s", idx+1, e)
+                return
+            profile, quote = profile_task.result(), quote_task.result()
+
+            updated = build_updated_row(name, symbol, price, shares, mktval, profile, quote)
+            await write_q.put((idx, updated))
+            dev_log.debug("Row %d: Enriched and queued for write.", idx+1)
+            return updated
 
         except Exception as e:
-            log.error(f"Row {idx+1}: Unexpected error: {e}")
-        finally:
-            task_q.task_done()
+            log.error("Row %d: Unexpected error: %s", idx+1, e)
 
 # ==========================
-# WRITER
+# JOURNAL
 # ==========================
-def writer_loop(stop_event: threading.Event):
-    # Create/overwrite temp with header first
-    with open(TEMP_FILE, "w", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=EXPECTED_COLUMNS)
-        writer.writeheader()
-
-    # Append rows as workers produce them
-    while not stop_event.is_set() or not write_q.empty():
-        try:
-            item = write_q.get(timeout=0.5)
-        except Empty:
-            continue
+async def journal_task():
+    # Single consumer appending each enriched row as a JSON line, so a crashed run
+    # still leaves its finished rows on disk. Lines are buffered in memory and written
+    # and flushed in batches, whenever the queue runs dry or the buffer grows too big
+    buf = io.StringIO()
+
+    # Append, never truncate: a journal left by a crashed run is replayed by main()
+    async with aiofiles.open(JOURNAL_FILE, "a") as f:
+        while True:
+            item = await write_q.get()
+            try:
+                if item is not None:
+                    idx, row = item
+                    buf.write(json.dumps({"row": idx + 1, **row}, default=str) + "\n")
+                if item is None or write_q.empty() or buf.tell() >= WRITE_BUFFER_BYTES:
+                    await f.write(buf.getvalue())
+                    await f.flush()  # hand each batch to the OS, so it survives the process crashing
+                    buf.seek(0)
+                    buf.truncate()
+            except Exception as e:
+                log.error(f"Journal error: {e}")
+            finally:
+                write_q.task_done()
+            if item is None:  # sentinel
+                return
+
+def journal_header() -> dict:
+    """Identify the exact input file a journal belongs to (path, size, mtime)."""
+    st = os.stat(INPUT_FILE)
+    return {"input": os.path.abspath(INPUT_FILE), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+def load_journal(header: dict) -> dict:
+    """
+    Rows a previous, crashed run on this same input already enriched: 1-based row number -> row dict.
+    A journal written for another input (or an older version of this one) is discarded, never replayed.
+    """
+    done = {}
+    if not os.path.exists(JOURNAL_FILE):
+        return done
+    with open(JOURNAL_FILE) as f:
         try:
-            with open(TEMP_FILE, "a", newline="") as f:
-                writer = csv.DictWriter(f, fieldnames=EXPECTED_COLUMNS)
-                writer.writerow(item)
-        except Exception as e:
-            log.error(f"Writer error: {e}")
-        finally:
-            write_q.task_done()
+            matches = json.loads(f.readline()) == {"journal": header}
+        except json.JSONDecodeError:
+            matches = False
+        if matches:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # last line may be torn by the crash
+                done[entry.pop("row")] = entry
+    if not matches:
+        log.warning("Discarding %s: it was not written for the current %s", JOURNAL_FILE, INPUT_FILE)
+        os.remove(JOURNAL_FILE)
+    return done
 
 # ==========================
 # MAIN
 # ==========================
-def main():
-    # Read input CSV
-    df = pd.read_csv(INPUT_FILE)
-    # Validate columns
-    if not all(col in df.columns for col in EXPECTED_COLUMNS):
-        raise ValueError(f"Input file must contain columns: {EXPECTED_COLUMNS}")
-
+async def main():
+    # Resume: rows already in the journal are reused instead of being fetched again
+    header = journal_header()
+    journaled = load_journal(header)
+    if journaled:
+        log.warning("Resuming from %s: %d rows already enriched", JOURNAL_FILE, len(journaled))
+    if os.path.exists(JOURNAL_FILE):
+        # End a line torn by the crash, so the first row appended below isn't glued onto it
+        with open(JOURNAL_FILE, "rb+") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+    else:
+        with open(JOURNAL_FILE, "w") as f:
+            f.write(json.dumps({"journal": header}) + "\n")
+    journaled_rows = list(journaled)
+    journal = asyncio.create_task(journal_task())
+
+    # One session (one keep-alive connection pool) shared by every row
+    connector = aiohttp.TCPConnector(limit=MAX_INFLIGHT, keepalive_timeout=75, ttl_dns_cache=600)
+    timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT_SECS)
+    headers = {"X-Finnhub-Token": API_KEY}
+    sem = asyncio.Semaphore(NUM_WORKERS)
     print(f"Using input file: {INPUT_FILE}")
-    print("\n--- Preview of Input Data ---")
-    print(df.head(), "\n")
-
-    # Enqueue tasks
-    for idx, row in df.iterrows():
-        row_dict = {col: row[col] for col in EXPECTED_COLUMNS}
-        task_q.put((idx, row_dict))
-
-    # Start writer thread
-    writer_stop = threading.Event()
-    writer_thread = threading.Thread(target=writer_loop, args=(writer_stop,), name="Writer", daemon=True)
-    writer_thread.start()
-
-    # Start workers
-    workers = []
-    for i in range(NUM_WORKERS):
-        t = threading.Thread(target=worker_loop, name=f"Worker-{i+1}", daemon=True)
-        t.start()
-        workers.append(t)
-
-    # Graceful shutdown handler
-    def handle_sigint(sig, frame):
-        print("\nSIGINT received. Finishing in-flight tasks...")
-        # Let workers finish queue; writer drains any remaining rows
-        # We won't abruptly stop threads to avoid data loss.
-    signal.signal(signal.SIGINT, handle_sigint)
-
-    # Wait until all tasks are processed
-    task_q.join()
-    # Wait until all writes are flushed
-    write_q.join()
-
-    # Stop writer and limiter
-    writer_stop.set()
-    rate_limiter.stop()
-
-    # Give writer a moment to exit
-    writer_thread.join(timeout=2.0)
-
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
+        # Stream the input in chunks so memory stays bounded by CSV_CHUNK_ROWS, not the file size;
+        # every cell stays a string and NA detection is skipped, so blanks read as "" (no NaN to clean up)
+        reader = pd.read_csv(INPUT_FILE, chunksize=CSV_CHUNK_ROWS, dtype=str, na_filter=False,
+                             usecols=lambda col: col in EXPECTED_COLUMNS)
+        for n, df in enumerate(reader):
+            # Validate columns
+            if not all(col in df.columns for col in EXPECTED_COLUMNS):
+                raise ValueError(f"Input file must contain columns: {EXPECTED_COLUMNS}")
+            if n == 0:
+                print("\n--- Preview of Input Data ---")
+                print(df.head(), "\n")
+
+            # Normalize the key columns in one vectorized pass
+            df["Name"] = df["Name"].str.strip()
+            df["Symbol"] = df["Symbol"].str.strip()
+
+            # Rows missing both Name and Symbol can't be enriched: log them in bulk and drop them
+            bad = df["Name"].eq("") & df["Symbol"].eq("")
+            if bad.any():
+                log.error(f"Rows {(df.index[bad] + 1).tolist()}: both Name and Symbol missing. Skipping.")
+                df = df.loc[~bad]
+
+            # Rows a crashed run already enriched come straight from the journal
+            resumed = (df.index + 1).isin(journaled_rows)
+            out = {i: journaled[i + 1] for i in df.index[resumed]}
+            df = df.loc[~resumed]
+
+            # Lookups/profiles are memoized, so keys repeated across chunks are still fetched once
+            df = await resolve_missing_keys(session, sem, df)
+
+            # Exported once to plain dicts; rows with every field filled need no API call and are kept as-is
+            records = df[EXPECTED_COLUMNS].to_dict(orient="records")
+            needs_api = df[EXPECTED_COLUMNS].eq("").any(axis=1).to_numpy().nonzero()[0].tolist()
+            row_idx = df.index.tolist()
+            enriched = await asyncio.gather(*(enrich_record(session, sem, row_idx[pos], records[pos])
+                                              for pos in needs_api))
+            out.update(zip(row_idx, records))
+            out.update((row_idx[pos], row) for pos, row in zip(needs_api, enriched))
+
+            # Back in input order; append this chunk's enriched rows in one pandas pass
+            rows = [out[i] for i in sorted(out) if out[i] is not None]
+            pd.DataFrame(rows, columns=EXPECTED_COLUMNS).to_csv(
+                TEMP_FILE, index=False, mode="w" if n == 0 else "a", header=(n == 0))
+
+    # Flush remaining rows and stop the journal
+    await write_q.put(None)
+    await journal
+
+    # Drop the journal first: once the input is rewritten its row numbers no longer line up,
+    # so a crash between these two steps must not leave a journal behind to replay
+    os.remove(JOURNAL_FILE)
     # Atomic replace
     os.replace(TEMP_FILE, INPUT_FILE)
     print(f"\nIncremental update complete. Updated file saved at: {INPUT_FILE}")
 
 if __name__ == "__main__":
     try:
-        main()
+        asyncio.run(main())
     except Exception as e:
         log.error(f"Fatal error: {e}")
         raise
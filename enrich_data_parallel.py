@@ -1,12 +1,19 @@
 import os
+import io
 import logging
+import logging.handlers
+import queue
 from dotenv import load_dotenv
 import finnhub
+import requests
+from requests.adapters import HTTPAdapter
 import threading
 import time
-from queue import Queue, Empty
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import pandas as pd
-import csv
+import json
+import sqlite3
 # ---------------------------
 # Config (env-overridable)
 # ---------------------------
@@ -14,20 +21,26 @@ load_dotenv()
 
 MAX_CALLS_PER_MIN        = int(os.getenv("MAX_CALLS_PER_MIN", "50"))     # global cap
 NUM_WORKERS              = int(os.getenv("NUM_WORKERS", "5"))            # threads
-WORKER_COOLDOWN_SECS     = int(os.getenv("WORKER_COOLDOWN_SECS", "60"))  # sleep after quota
-PER_WORKER_CALLS_PER_MIN = max(1, MAX_CALLS_PER_MIN // max(1, NUM_WORKERS))
+CSV_CHUNK_ROWS           = int(os.getenv("CSV_CHUNK_ROWS", "65536"))     # input rows held in memory at once
+CACHE_TTL_SECS           = int(os.getenv("CACHE_TTL_SECS", "86400"))     # profiles / symbol lookups
+QUOTE_TTL_SECS           = 60                                            # quotes go stale after a minute
+SP500_TTL_SECS           = int(os.getenv("SP500_TTL_SECS", "86400"))     # refresh the S&P 500 list daily (same as fetch_data.py)
 
 INPUT_FILE  = os.getenv("INPUT_FILE") or "input/data.csv"
 TEMP_FILE   = os.getenv("TEMP_FILE")  or "output/data_tmp.csv"
 ERROR_LOG   = os.getenv("ERROR_LOG")  or "output/error.log"
 DEV_LOG     = os.getenv("DEV_LOG")     or "output/dev.log"
+CACHE_FILE  = os.getenv("CACHE_FILE")  or "output/api_cache.sqlite"
+SP500_FILE  = os.getenv("SP500_FILE")  or "output/sp500.csv"   # local Name -> Symbol list
+SP500_URL   = "https://en.wikipedia.org/wiki/List_of_S%26P_500_companies"
+LOG_LEVEL   = os.getenv("LOG_LEVEL", "INFO").upper()  # DEBUG adds per-row trace to dev.log
 EXPECTED_COLUMNS = ["Name", "Symbol", "Price", "# of Shares", "Market Value"]
 
 os.makedirs("output", exist_ok=True)
 
 # Configure logging with separate handlers
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+logger.setLevel(LOG_LEVEL)
 
 # Clear any existing handlers
 logger.handlers.clear()
@@ -35,9 +48,9 @@ logger.handlers.clear()
 # Create formatters
 formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 
-# File handler for INFO and above (dev.log)
+# File handler for everything the logger lets through (dev.log)
 dev_handler = logging.FileHandler(DEV_LOG)
-dev_handler.setLevel(logging.INFO)
+dev_handler.setLevel(logging.DEBUG)
 dev_handler.setFormatter(formatter)
 
 # File handler for ERROR and above (error.log)
@@ -45,53 +58,60 @@ error_handler = logging.FileHandler(ERROR_LOG)
 error_handler.setLevel(logging.ERROR)
 error_handler.setFormatter(formatter)
 
-# Console handler for INFO and above
+# Console handler for WARNING and above (progress stays in dev.log)
 console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
+console_handler.setLevel(logging.WARNING)
 console_handler.setFormatter(formatter)
 
-# Add handlers to logger
-logger.addHandler(dev_handler)
-logger.addHandler(error_handler)
-logger.addHandler(console_handler)
+# Workers only enqueue records; one listener thread formats and writes them to every sink,
+# so no worker blocks on file I/O or the handlers' locks
+log_q = queue.Queue(-1)
+logger.addHandler(logging.handlers.QueueHandler(log_q))
+log_listener = logging.handlers.QueueListener(log_q, dev_handler, error_handler, console_handler,
+                                              respect_handler_level=True)
+log_listener.start()
 
 API_KEY = os.getenv("FINNHUB_API_KEY")
 if not API_KEY:
     raise ValueError("FINNHUB_API_KEY not found in environment/.env")
 finnhub_client = finnhub.Client(api_key=API_KEY)
+# The SDK already reuses one keep-alive session; size its pool so every worker (plus headroom)
+# keeps a warm connection instead of dropping it and paying a fresh TLS handshake per call.
+# _session is private to the SDK, so skip the tuning (default pool) if a release renames it
+sdk_session = getattr(finnhub_client, "_session", None)
+if sdk_session is not None:
+    sdk_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=NUM_WORKERS * 2))
+else:
+    logger.warning("finnhub client has no _session; keeping its default connection pool")
 
 class MinuteRateLimiter:
-    """Simple token bucket refilled once per minute."""
+    """Continuous token bucket: refills at max_per_minute/60 tokens per second, no refill thread."""
     def __init__(self, max_per_minute: int):
-        self.max = max_per_minute
-        self.tokens = max_per_minute
+        self.capacity = max_per_minute
+        self.rate = max_per_minute / 60.0
+        self.tokens = float(max_per_minute)
+        self.last = time.monotonic()
         self.lock = threading.Lock()
         self.cv = threading.Condition(self.lock)
         self._stop = False
-        self.refill_thread = threading.Thread(target=self._refill_loop, daemon=True)
-        self.refill_thread.start()
-
-    def _refill_loop(self):
-        while not self._stop:
-            time.sleep(60)
-            with self.lock:
-                self.tokens = self.max
-                self.cv.notify_all()
 
     def acquire(self):
         with self.lock:
-            while self.tokens <= 0 and not self._stop:
-                self.cv.wait(timeout=0.1)
-            if self._stop:
-                return False
-            self.tokens -= 1
-            return True
+            while not self._stop:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                # Wait just until the next whole token accrues (stop() wakes us early)
+                self.cv.wait(timeout=(1 - self.tokens) / self.rate)
+            return False
 
     def stop(self):
         with self.lock:
             self._stop = True
             self.cv.notify_all()
-        self.refill_thread.join(timeout=1)
 
 rate_limiter = MinuteRateLimiter(MAX_CALLS_PER_MIN)
 
@@ -102,93 +122,141 @@ def sdk_call(fn, *args, **kwargs):
         raise RuntimeError("Rate limiter stopped")
     return fn(*args, **kwargs)
 
+class ApiCache:
+    """SQLite cache of API responses (one JSON row per key) shared by every worker and every run."""
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, ts REAL, val TEXT)")
+            # Nothing older than the longest TTL can ever be served again: drop it so the file stays small
+            self.conn.execute("DELETE FROM cache WHERE ts < ?", (time.time() - max(CACHE_TTL_SECS, QUOTE_TTL_SECS),))
+            self.conn.commit()
+
+    def get(self, key: str, ttl: float):
+        with self.lock:
+            row = self.conn.execute("SELECT ts, val FROM cache WHERE key = ?", (key,)).fetchone()
+        if row and time.time() - row[0] < ttl:
+            return json.loads(row[1])
+        return None
+
+    def put(self, key: str, val):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO cache (key, ts, val) VALUES (?, ?, ?)",
+                              (key, time.time(), json.dumps(val)))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+api_cache = ApiCache(CACHE_FILE)
+
+# Duplicate symbols/names in the input share one call per run: the first row to need a key
+# fetches it, rows needing it meanwhile wait on the same Future instead of calling again
+_memo = {}
+_memo_lock = threading.Lock()
+
+def cached_sdk_call(key: tuple, ttl: float, fn, *args, **kwargs):
+    """sdk_call() made at most once per key per run, served from api_cache when a fresh response is stored."""
+    key = json.dumps(key)
+    with _memo_lock:
+        fut = _memo.get(key)
+        owner = fut is None
+        if owner:
+            fut = _memo[key] = Future()
+    if not owner:
+        return fut.result()
+
+    try:
+        val = api_cache.get(key, ttl)
+        if val is None:
+            val = sdk_call(fn, *args, **kwargs)
+            api_cache.put(key, val)
+    except Exception as e:
+        # Don't memoize failures: waiting rows see this error, later rows try again
+        with _memo_lock:
+            del _memo[key]
+        fut.set_exception(e)
+        raise
+    fut.set_result(val)
+    return val
+
+def load_name_index() -> dict:
+    """Map lowercased S&P 500 company names to symbols, so those names resolve without symbol_lookup."""
+    if not os.path.exists(SP500_FILE) or time.time() - os.path.getmtime(SP500_FILE) > SP500_TTL_SECS:
+        try:
+            # Same Wikipedia table fetch_data.py reads; only the constituents table is parsed.
+            # Fetched with a timeout so a stalled connection can't hang the script at import
+            resp = requests.get(SP500_URL, timeout=10,
+                                headers={"User-Agent": "Mozilla/5.0 (X11; Linux x86_64) Chrome/123.0 Safari/537.36"})
+            resp.raise_for_status()
+            sp500 = pd.read_html(io.StringIO(resp.text), attrs={"id": "constituents"})[0]
+            sp500 = sp500[["Security", "Symbol"]].rename(columns={"Security": "Name"})
+            sp500.to_csv(SP500_FILE, index=False)
+        except Exception as e:
+            # A stale copy, if there is one, is still better than no local resolver
+            logger.warning("Could not refresh the S&P 500 list: %s", e)
+    if not os.path.exists(SP500_FILE):
+        return {}
+    try:
+        sp500 = pd.read_csv(SP500_FILE, dtype=str, na_filter=False)
+    except Exception as e:
+        logger.warning("S&P 500 list unavailable, resolving names through symbol_lookup only: %s", e)
+        return {}
+    return dict(zip(sp500["Name"].str.strip().str.lower(), sp500["Symbol"].str.strip()))
+
+name_index = {}  # filled by main(), so importing this module never touches the network
+
     # ---------------------------
-# Worker + writer setup
+# Workers
 # ---------------------------
-todo_q = Queue()#rows in csv to be processed
-write_q = Queue()#processed rowsa waitng to be written
-
-
-def normalize_cell(v):
-    if v is None:
-        return ""
-    if isinstance(v, float) and pd.isna(v):
-        return ""
-    s = str(v).strip()
-    return "" if s.lower() == "nan" else s
-
-def enrich_row(row_idx_1based: int, row_dict: dict):
-    """Return (updated_row_dict, calls_used)."""
-    calls_used = 0
-    name   = normalize_cell(row_dict.get("Name"))
-    symbol = normalize_cell(row_dict.get("Symbol"))
-
-    price  = row_dict.get("Price")
-    shares = row_dict.get("# of Shares")
-    mval   = row_dict.get("Market Value")
-
-    price  = "" if (price  is None or (isinstance(price, float)  and pd.isna(price)))  else price
-    shares = "" if (shares is None or (isinstance(shares, float) and pd.isna(shares))) else shares
-    mval   = "" if (mval   is None or (isinstance(mval, float)   and pd.isna(mval)))   else mval
-
-    if not name and not symbol:
-        logger.error(f"Row {row_idx_1based} is missing key feature, cannot fetch data")
-        return {
-            "Name": row_dict.get("Name", ""), "Symbol": row_dict.get("Symbol", ""),
-            "Price": row_dict.get("Price", ""), "# of Shares": row_dict.get("# of Shares", ""),
-            "Market Value": row_dict.get("Market Value", "")
-        }, calls_used
-
-    # If Symbol missing but Name present: lookup symbol
-    if not symbol and name:
+
+def enrich_row(row_idx_1based: int, row: tuple):
+    """Return the updated row as a tuple in EXPECTED_COLUMNS order. Cells arrive pre-normalized by main() (blanks are "")."""
+    name, symbol, price, shares, mval = row
+
+    # If Symbol missing but Name present: resolve it from the local S&P 500 list, else lookup symbol
+    if not symbol and name.lower() in name_index:
+        symbol = name_index[name.lower()]
+        logger.debug("Row %d: Found symbol '%s' for '%s' in the S&P 500 list.", row_idx_1based, symbol, name)
+    elif not symbol and name:
         try:
-            lookup = sdk_call(finnhub_client.symbol_lookup, name)
-            calls_used += 1
+            lookup = cached_sdk_call(("lookup", name), CACHE_TTL_SECS,
+                                     finnhub_client.symbol_lookup, name)
             if lookup and lookup.get("count", 0) > 0:
-                symbol = normalize_cell(lookup["result"][0].get("symbol"))
-                logger.info(f"Row {row_idx_1based}: Found symbol '{symbol}' for '{name}'.")
+                symbol = (lookup["result"][0].get("symbol") or "").strip()
+                logger.debug("Row %d: Found symbol '%s' for '%s'.", row_idx_1based, symbol, name)
             else:
-                logger.warning(f"Row {row_idx_1based}: No symbol found for '{name}'. Leaving row as-is.")
-                return {
-                    "Name": name, "Symbol": "", "Price": price,
-                    "# of Shares": shares, "Market Value": mval
-                }, calls_used
+                logger.warning("Row %d: No symbol found for '%s'. Leaving row as-is.", row_idx_1based, name)
+                return (name, "", price, shares, mval)
         except Exception as e:
-            logger.error(f"Row {row_idx_1based}: symbol_lookup error for name='{name}': {e}")
-            return {
-                "Name": name, "Symbol": "", "Price": price,
-                "# of Shares": shares, "Market Value": mval
-            }, calls_used
+            logger.error("Row %d: symbol_lookup error for name='%s': %s", row_idx_1based, name, e)
+            return (name, "", price, shares, mval)
 
     # If Name missing but Symbol present: get profile to fill name
     profile = None
     if not name and symbol:
         try:
-            profile = sdk_call(finnhub_client.company_profile2, symbol=symbol)
-            calls_used += 1
-            name = normalize_cell(profile.get("name", "")) or name
+            profile = cached_sdk_call(("profile", symbol), CACHE_TTL_SECS,
+                                      finnhub_client.company_profile2, symbol=symbol)
+            name = (profile.get("name") or "").strip()
             if name:
-                logger.info(f"Row {row_idx_1based}: Found name '{name}' for symbol '{symbol}'.")
+                logger.debug("Row %d: Found name '%s' for symbol '%s'.", row_idx_1based, name, symbol)
             else:
-                logger.warning(f"Row {row_idx_1based}: No name found for symbol '{symbol}'. Leaving row as-is.")
-                return {
-                    "Name": "", "Symbol": symbol, "Price": price,
-                    "# of Shares": shares, "Market Value": mval
-                }, calls_used
+                logger.warning("Row %d: No name found for symbol '%s'. Leaving row as-is.", row_idx_1based, symbol)
+                return ("", symbol, price, shares, mval)
         except Exception as e:
-            logger.error(f"Row {row_idx_1based}: company_profile2 error for '{symbol}': {e}")
-            return {
-                "Name": "", "Symbol": symbol, "Price": price,
-                "# of Shares": shares, "Market Value": mval
-            }, calls_used
+            logger.error("Row %d: company_profile2 error for '%s': %s", row_idx_1based, symbol, e)
+            return ("", symbol, price, shares, mval)
 
     # Fetch profile + quote to fill missing values
     try:
         if profile is None:
-            profile = sdk_call(finnhub_client.company_profile2, symbol=symbol)
-            calls_used += 1
-        quote = sdk_call(finnhub_client.quote, symbol)
-        calls_used += 1
+            profile = cached_sdk_call(("profile", symbol), CACHE_TTL_SECS,
+                                      finnhub_client.company_profile2, symbol=symbol)
+        quote = cached_sdk_call(("quote", symbol), QUOTE_TTL_SECS, finnhub_client.quote, symbol)
 
         if price == "":
             price = quote.get("c", "")
@@ -197,82 +265,100 @@ def enrich_row(row_idx_1based: int, row_dict: dict):
         if mval == "":
             mval = profile.get("marketCapitalization", "")
     except Exception as e:
-        logger.error(f"Row {row_idx_1based}: fetch profile/quote error for '{symbol}': {e}")
+        logger.error("Row %d: fetch profile/quote error for '%s': %s", row_idx_1based, symbol, e)
 
-    return {
-        "Name": name, "Symbol": symbol, "Price": price,
-        "# of Shares": shares, "Market Value": mval
-    }, calls_used
+    return (name, symbol, price, shares, mval)
 
-def worker_fn(worker_id: int):
-    used_this_minute = 0
+def drain(wid: int, deques: list, locks: list, out: list):
+    """Enrich rows from this worker's own deque (tail first), stealing from the other deques' heads once it runs dry."""
+    # Pacing comes solely from the global token bucket inside sdk_call
+    n = len(deques)
     while True:
-        try:
-            row_idx, row_dict = todo_q.get(timeout=0.2)
-        except Empty:
-            return
-        updated, calls_used = enrich_row(row_idx, row_dict)
-        write_q.put(updated)
-        used_this_minute += calls_used
-
-        # Per-worker quota enforcement
-        if used_this_minute >= PER_WORKER_CALLS_PER_MIN:
-            logger.info(f"Worker {worker_id}: used {used_this_minute} calls. Cooling down {WORKER_COOLDOWN_SECS}s.")
-            time.sleep(WORKER_COOLDOWN_SECS)
-            used_this_minute = 0
-
-        todo_q.task_done()
-
-def writer_fn(temp_file: str, header: list):
-    with open(temp_file, "w", newline="") as f:
-        w = csv.DictWriter(f, fieldnames=header)
-        w.writeheader()
-        while True:
-            item = write_q.get()
-            if item is None:  # sentinel
-                write_q.task_done()
+        item = None
+        with locks[wid]:
+            if deques[wid]:
+                item = deques[wid].pop()
+        for k in range(1, n):
+            if item is not None:
                 break
-            w.writerow(item)
-            write_q.task_done()
+            victim = (wid + k) % n
+            with locks[victim]:
+                if deques[victim]:
+                    item = deques[victim].popleft()
+        if item is None:
+            return
+        pos, row_idx, row = item
+        out[pos] = enrich_row(row_idx, row)
+
+def flush(batch):
+    """Wait for a chunk's drain tasks, then append its rows to the temp file in one pandas pass."""
+    futures, out = batch
+    for f in futures:
+        f.result()
+    pd.DataFrame.from_records(out, columns=EXPECTED_COLUMNS).to_csv(TEMP_FILE, mode="a", header=False, index=False)
 
 def main():
     # Validate input CSV
     if not INPUT_FILE or not os.path.exists(INPUT_FILE):
         raise FileNotFoundError(f"Input file not found at: {INPUT_FILE}")
 
-    df = pd.read_csv(INPUT_FILE)
-    for col in EXPECTED_COLUMNS:
-        if col not in df.columns:
-            df[col] = ""
-
     logger.info(f"Using input file: {INPUT_FILE}")
-    logger.info(f"Global cap: {MAX_CALLS_PER_MIN}/min; Workers: {NUM_WORKERS}; Per-worker cap: {PER_WORKER_CALLS_PER_MIN}/min")
-
-    # Fill work queue
-    for i, row in df.iterrows():
-        todo_q.put((i + 1, row.to_dict()))
-
-    # Start writer
-    writer_th = threading.Thread(target=writer_fn, args=(TEMP_FILE, EXPECTED_COLUMNS), daemon=True)
-    writer_th.start()
-
-    # Start workers
-    workers = [threading.Thread(target=worker_fn, args=(wid,), daemon=True)
-               for wid in range(1, NUM_WORKERS + 1)]
-    for t in workers:
-        t.start()
-
-    # Wait for completion
-    todo_q.join()
-    write_q.put(None)  # stop writer
-    write_q.join()
-    writer_th.join(timeout=1)
+    logger.info(f"Global cap: {MAX_CALLS_PER_MIN}/min; Workers: {NUM_WORKERS}")
+
+    name_index.update(load_name_index())
+
+    # Header first; each chunk is appended below once its rows are enriched
+    pd.DataFrame(columns=EXPECTED_COLUMNS).to_csv(TEMP_FILE, index=False)
+
+    # Stream the input in chunks so memory stays bounded by CSV_CHUNK_ROWS, not the file size;
+    # every cell stays a string and NA detection is skipped, so blanks read as "" (no NaN to clean up)
+    reader = pd.read_csv(INPUT_FILE, chunksize=CSV_CHUNK_ROWS, dtype=str, na_filter=False,
+                         usecols=lambda col: col in EXPECTED_COLUMNS)
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as ex:
+        pending = None  # previous chunk's (futures, rows), written out while the next one is in flight
+        for df in reader:
+            for col in EXPECTED_COLUMNS:
+                if col not in df.columns:
+                    df[col] = ""
+
+            # Normalize the key columns in one vectorized pass, so workers can branch on plain values
+            for col in ("Name", "Symbol"):
+                df[col] = df[col].str.strip()
+
+            # Rows missing both Name and Symbol can't be enriched: log them in bulk and pass them through as-is.
+            # Rows with every field filled need no API call and pass through as-is too
+            bad = df["Name"].eq("") & df["Symbol"].eq("")
+            if bad.any():
+                logger.error(f"Rows {(df.index[bad] + 1).tolist()} are missing key feature, cannot fetch data")
+            needs_api = df[EXPECTED_COLUMNS].eq("").any(axis=1) & ~bad
+
+            # Every row needing the API is dealt round-robin into one deque per worker (rows exported once
+            # to plain tuples, no per-row Series or dict), so workers pop from their own deque, not one shared queue
+            out = list(df[EXPECTED_COLUMNS].itertuples(index=False, name=None))  # slots in input order, filled by workers
+            deques = [deque() for _ in range(NUM_WORKERS)]
+            locks = [threading.Lock() for _ in range(NUM_WORKERS)]
+            row_nums = (df.index + 1).tolist()
+            for n, pos in enumerate(needs_api.to_numpy().nonzero()[0].tolist()):
+                deques[n % NUM_WORKERS].append((pos, row_nums[pos], out[pos]))
+            futures = [ex.submit(drain, wid, deques, locks, out) for wid in range(NUM_WORKERS)]
+
+            # Write out the previous chunk while this one is being enriched
+            previous, pending = pending, (futures, out)
+            if previous is not None:
+                flush(previous)
+
+        if pending is not None:
+            flush(pending)
 
     # Stop limiter and replace file
     rate_limiter.stop()
+    api_cache.close()
     os.replace(TEMP_FILE, INPUT_FILE)
     logger.info(f"Incremental update complete. Updated file saved at: {INPUT_FILE}")
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        log_listener.stop()  # flush queued log records, even on failure
 